@@ -7,34 +7,90 @@ usage: /path/to/$0
 
 """
 
-import datetime
 import json
 import logging
 import os
 import sys
+import time
+
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+# pick the json parser once, both accept bytes
+if HAVE_ORJSON:
+    JSON_LOADS = orjson.loads # pylint: disable=no-member
+else:
+    JSON_LOADS = json.loads
+
+def read_last_line(filename: str):
+
+    """
+    return the last line of a file without reading the whole file
+    """
+
+    with open(filename, 'rb') as json_file:
+        pos = json_file.seek(0, os.SEEK_END)
+        buf = b''
+        # read backwards in blocks until a complete last line is buffered
+        while pos > 0 and b'\n' not in buf.rstrip(b'\n'):
+            step = min(4096, pos)
+            pos -= step
+            json_file.seek(pos)
+            buf = json_file.read(step) + buf
+
+    return buf.splitlines()[-1]
 
 def handle_dsn(filename: str):
 
     """
-    add orig_rcpt to discard list
+    return the discard map line for orig_rcpt
     """
-    with open(filename, 'r', encoding='utf-8') as json_file:
-        line = None
-        for line in json_file:
-            # skip all lines
-            pass
-        # 'line' is now the last line ...
-        dsn_data = json.loads(line)
 
-        date = dsn_data['date']
-        orig_rcpt = dsn_data['orig_rcpt']
+    # only the last line is of interest
+    # dmarc_dsn_processor.py keep it in ../last/, older data_dirs lack it
+    try:
+        with open('../last/' + filename, 'rb') as file:
+            line = file.read()
+    except FileNotFoundError:
+        line = read_last_line(filename)
+
+    dsn_data = JSON_LOADS(line)
+
+    date = dsn_data['date']
+    orig_rcpt = dsn_data['orig_rcpt']
 
-        if date is None:
-            date = 'unknown'
+    if date is None:
+        date = 'unknown'
 
-        logging.debug("DEBUG: orig_rcpt=%s, domain=%s, date=%s", orig_rcpt, filename, date)
-        map_line = f"{orig_rcpt} discard:report for {file} bounced {date} last time"
-        print(map_line)
+    logging.debug("DEBUG: orig_rcpt=%s, domain=%s, date=%s", orig_rcpt, filename, date)
+    return f"{orig_rcpt} discard:report for {filename} bounced {date} last time"
+
+def build_table(domains_dir: str, threshold: float):
+
+    """
+    add all domain files modified after threshold to discard list
+    """
+
+    os.chdir(domains_dir)
+
+    # first collect the names, so the directory is closed before reading files
+    names = []
+    with os.scandir('.') as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if entry.stat().st_mtime > threshold:
+                names.append(entry.name)
+            else:
+                logging.debug("DEBUG: file %s is older then %s day(s)", entry.name, MIN_AGE)
+
+    # write the whole table at once instead of one write per line
+    map_lines = [handle_dsn(name) for name in names]
+    if map_lines:
+        sys.stdout.write('\n'.join(map_lines) + '\n')
 
 # main
 
@@ -60,17 +116,10 @@ if not os.path.exists(DATA_DIR + '/domains/'):
     logging.error('ERROR: %s/domains do not exist, check DATA_DIR', DATA_DIR)
     sys.exit(1)
 
-MIN_AGE_IS_INT = True
-MIN_AGE = os.getenv('MIN_AGE', '30')
 try:
-    int(MIN_AGE)
+    MIN_AGE = int(os.getenv('MIN_AGE', '30'))
 except ValueError:
-    MIN_AGE_IS_INT = False
-
-if MIN_AGE_IS_INT:
-    MIN_AGE = int(MIN_AGE)
-else:
-    logging.error("ERROR: ENV[MIN_AGE] = '%s', but must be an integer", MIN_AGE)
+    logging.error("ERROR: ENV[MIN_AGE] = '%s', but must be an integer", os.getenv('MIN_AGE'))
     sys.exit(1)
 
 # don't accept negative ages
@@ -83,15 +132,7 @@ if MIN_AGE > 90:
     logging.error("ERROR: ENV[MIN_AGE] must be max. 90")
     sys.exit(1)
 
-TODAY = datetime.datetime.today()
-
-os.chdir(DATA_DIR + '/domains/')
-for file in os.listdir('.'):
-    if os.path.isfile(file):
-        file_mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(file))
-        age = TODAY - file_mod_time
+# files modified before this point in time are too old
+THRESHOLD = time.time() - MIN_AGE * 86400
 
-        if age.days < MIN_AGE:
-            handle_dsn(file)
-        else:
-            logging.debug("DEBUG: file %s is older then %s day(s)", file, MIN_AGE)
+build_table(DATA_DIR + '/domains/', THRESHOLD)
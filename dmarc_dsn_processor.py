@@ -21,33 +21,60 @@ the following envoronment variables are used:
 
 
 Requirements on Debian:
-apt-get install python3-minimal python3-json5 python3-validators
+apt-get install python3-minimal python3-json5
+
+Optional, for faster json serialization:
+apt-get install python3-orjson
 
 """
 
 import datetime
-import email
+import functools
 import json
 import logging
 import os
 import re
 import sys
-import validators
+from collections import defaultdict
+
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+# a domain name, with at least two labels
+DOMAIN_PATTERN = ("(?=.{1,253}\\Z)(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\\.)+"
+    "(?:[A-Za-z]{2,63}|xn--[A-Za-z0-9-]{1,59})\\Z")
+RE_DOMAIN = re.compile(DOMAIN_PATTERN)
 
-RE_MULTILINE     = re.compile("\n\\s+")
-RE_REPORT_DOMAIN = re.compile("^.*Report Domain:\\s")
-RE_SUBMITTER     = re.compile("\\sSubmitter:\\s.*$")
+# an address, the local part is not checked in detail,
+# only printable ASCII without '@' is allowed
+RE_EMAIL = re.compile("[\\x21-\\x3f\\x41-\\x7e]{1,64}@" + DOMAIN_PATTERN)
 
-# [Final|Orginal]-Recipient may have a space or even not:
-# Final-Resipient: rfc822; with_space@example.org
-# Original-Recipient: rfc822;without_space@example.org
-RE_822_PREFIX    = re.compile("rfc822;\\s?")
+# report_domain in the Subject of a dmarc report
+RE_SUBJECT_REPORT_DOMAIN = re.compile("Report Domain:\\s(\\S+)")
+
+# report_domain in the message body, every occurrence is tried
+# no leading or trailing '.*', the search starts at the literal text
+RE_BODY_REPORT_DOMAIN = re.compile("Report Domain:\\s(\\S+)\\sSubmitter")
 
 # report_domain in Google Groups DSN, References Header
-RE_REFERENCES_REPORT_DOMAIN = re.compile("^<(.*)-\\d+@.*$")
+# no '.*', the classes stop at '@' and '>' instead of backtracking
+RE_REFERENCES_REPORT_DOMAIN = re.compile("^<([^<>@]+)-\\d+@[^<>]*>")
+
+# sender of Google Groups DSN
+GOOGLE_DAEMON_FROM = "Mail Delivery Subsystem <mailer-daemon@googlemail.com>"
 
-# report_domain somewhere in the whole message
-RE_BODY_REPORT_DOMAIN = re.compile("^.*Report Domain:\\s(.*)\\sSubmitter.*$", flags=re.MULTILINE)
+@functools.lru_cache(maxsize=1)
+def get_date():
+
+    """
+    return today as YYYYMMDD, computed only once and only if needed
+    """
+
+    # all records of this run share one date string
+    return datetime.date.today().strftime("%Y%m%d")
 
 def unfold(header_value: str):
 
@@ -55,9 +82,61 @@ def unfold(header_value: str):
     return the header value without linebreaks
     """
 
+    # most headers are not folded at all
+    if '\n' not in header_value:
+        return header_value
+
     # continuation lines (intended with SPACES) are replaced
-    # by exactly one SPACE
-    return re.sub(RE_MULTILINE, ' ', header_value)
+    # by exactly one SPACE, this also drop a CR before the linebreak
+    # and collapse other runs of whitespace
+    return ' '.join(header_value.split())
+
+def decode_header_value(value: str):
+
+    """
+    return a raw header value with 8bit characters decoded as utf-8
+    """
+
+    # a message parsed from bytes keep 8bit characters as surrogates,
+    # msg.get() would return them as email.header.Header object
+    return value.encode('ascii', 'surrogateescape').decode('utf-8', 'replace')
+
+def get_header(msg, name: str):
+
+    """
+    return the first header 'name' of msg as str, None if missing
+    """
+
+    name = name.lower()
+    for key, value in msg.raw_items():
+        if key.lower() == name:
+            return decode_header_value(value)
+    return None
+
+def get_headers(msg):
+
+    """
+    return all headers of msg as dict with lower case names
+    """
+
+    headers = {}
+    for key, value in msg.raw_items():
+        # like msg.get(), the first header of a name is used
+        headers.setdefault(key.lower(), decode_header_value(value))
+    return headers
+
+def strip_rfc822_prefix(address: str):
+
+    """
+    return the address without the 'rfc822;' address type
+    """
+
+    # [Final|Orginal]-Recipient may have a space or even not:
+    # Final-Resipient: rfc822; with_space@example.org
+    # Original-Recipient: rfc822;without_space@example.org
+    if address[:7].lower() == 'rfc822;':
+        return address[7:].lstrip()
+    return address
 
 def get_report_domain_from_subject(subject: str):
 
@@ -68,17 +147,15 @@ def get_report_domain_from_subject(subject: str):
     if subject is None:
         return None
 
-    report_domain = re.sub(RE_SUBMITTER, '',
-        re.sub(RE_REPORT_DOMAIN, '', subject))
-
-    if subject == report_domain:
-        # the re above didn't catch/match
+    match = RE_SUBJECT_REPORT_DOMAIN.search(subject)
+    if not match:
         logging.error("ERROR: unexpected subject, "
             "probably not a dsn for a dmarc report")
         save_message('no_subject_re_match')
         sys.exit(0)
 
-    if not validators.domain(report_domain):
+    report_domain = match.group(1)
+    if not RE_DOMAIN.match(report_domain):
         # the re above did not produce a raw domainname
         logging.error("ERROR: '%s' is no valid report_domain in string, "
             "probably not a dsn for a dmarc report", report_domain)
@@ -87,6 +164,18 @@ def get_report_domain_from_subject(subject: str):
 
     return report_domain
 
+def get_report_domain_from_body(mail_data: str):
+
+    """
+    find 'Report Domain: <domain> Submitter' somewhere in the whole message
+    """
+
+    match = RE_BODY_REPORT_DOMAIN.search(mail_data)
+    if match is None:
+        return None
+
+    return match.group(1)
+
 def process_googlegroups_dsn(msg):
 
     """
@@ -96,27 +185,30 @@ def process_googlegroups_dsn(msg):
     logging.debug("DEBUG: process_googlegroups_dsn")
     recipients = []
 
-    if msg['from'] != "Mail Delivery Subsystem <mailer-daemon@googlemail.com>":
+    if get_header(msg, 'from') != GOOGLE_DAEMON_FROM:
         logging.debug("DEBUG: process_googlegroups_dsn: not from googlemail.com")
         return recipients
 
+    # lookup each header only once
+    headers = {}
     for header_name in 'x-failed-recipients', 'references', 'in-reply-to':
-        if msg[header_name] is None:
+        headers[header_name] = get_header(msg, header_name)
+        if headers[header_name] is None:
             logging.debug("process_googlegroups_dsn: missing %s header", header_name)
             return recipients
 
-    if msg['references'] != msg['in-reply-to']:
+    if headers['references'] != headers['in-reply-to']:
         logging.debug("process_googlegroups_dsn: references header != in-reply-to header")
         return recipients
 
-    match = re.search(RE_REFERENCES_REPORT_DOMAIN, msg['references'])
+    match = RE_REFERENCES_REPORT_DOMAIN.search(headers['references'])
     if not match:
         logging.error("ERROR: no report_domain in google groups dsn references header")
         save_message('no_report_domain_in_references_header')
         sys.exit(0)
 
     report_domain = match.group(1)
-    if not validators.domain(report_domain):
+    if not RE_DOMAIN.match(report_domain):
         # the re above did not produce a raw domainname
         logging.error("ERROR: '%s' is no valid report_domain in string, "
             "probably not a dsn for a dmarc report", report_domain)
@@ -127,7 +219,7 @@ def process_googlegroups_dsn(msg):
     rcpt['report_domain'] = report_domain
     rcpt['action'] = 'failed'
     rcpt['status'] = '5.1.1' # https://datatracker.ietf.org/doc/html/rfc3463#section-3.2
-    rcpt['final_rcpt'] = msg['x-failed-recipients']
+    rcpt['final_rcpt'] = headers['x-failed-recipients']
     rcpt["orig_rcpt"] = rcpt["final_rcpt"]
 
     recipients.append(rcpt)
@@ -138,25 +230,25 @@ def process_with_extension(extension: str, mail_data: str):
     """
     process the email, for a known extension
     in this case, only the report domain must be searched
+    the message is searched as plain text, not parsed as MIME
     """
 
     logging.debug("DEBUG: process_with_extension")
 
     report_rcpt = extension.replace("=", "@")
-    if not validators.email(report_rcpt):
+    if not RE_EMAIL.match(report_rcpt):
         logging.error("ERROR: '%s' is not a valid report_rcpt", report_rcpt)
         save_message('no_report_rcpt_in_extension')
         sys.exit(0)
 
-    match = re.search(RE_BODY_REPORT_DOMAIN, mail_data)
-    if not match:
+    report_domain = get_report_domain_from_body(mail_data)
+    if report_domain is None:
         logging.error("ERROR: no report_domain in message")
         save_message('no_report_domain_in_message')
         sys.exit(0)
 
-    report_domain = match.group(1)
-    if not validators.domain(report_domain):
-        # the re above did not produce a raw domainname
+    if not RE_DOMAIN.match(report_domain):
+        # the search above did not produce a raw domainname
         logging.error("ERROR: '%s' is no valid report_domain in string,"
             "probably not a dsn for a dmarc report", report_domain)
         save_message('no_report_domain')
@@ -166,65 +258,143 @@ def process_with_extension(extension: str, mail_data: str):
     rcpt['report_domain'] = report_domain
     rcpt["action"] = "any_reason"
     rcpt["orig_rcpt"] = extension.replace("=", "@")
-    rcpt["date"] = DATE
+    rcpt["date"] = get_date()
 
     recipients = []
     recipients.append(rcpt)
     return recipients
 
-# pylint: disable=too-many-branches
-def process_dsn(mail_data: str):
+def process_delivery_status(part):
+
+    """
+    return the recipients listed in a message/delivery-status part
+    """
+
+    recipients = []
+
+    # the payload is a flat list of header blocks, no need to walk()
+    # the first block hold per-message fields, the others per-recipient fields
+    status_blocks = part.get_payload()
+    if not isinstance(status_blocks, list):
+        return recipients
+
+    # ask the logger once, not for every recipient
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    for subpart in status_blocks:
+        # https://datatracker.ietf.org/doc/html/rfc3461#section-6.3
+        # collect the headers once instead of searching them per field
+        headers = get_headers(subpart)
+
+        # cheap checks first, skip the per-message fields
+        action = headers.get('action')
+        if action is None or 'final-recipient' not in headers:
+            continue
+
+        if action == 'delayed':
+            logging.info('INFO: this is only about a delayed delivery')
+            sys.exit(0)
+
+        rcpt = {}
+        rcpt["action"] = action
+        rcpt["final_rcpt"] = strip_rfc822_prefix(headers['final-recipient'])
+        value = headers.get('original-recipient')
+        if value is not None:
+            rcpt["orig_rcpt"] = strip_rfc822_prefix(value)
+        else:
+            rcpt["orig_rcpt"] = rcpt["final_rcpt"]
+
+        rcpt["diag_code"] = None
+        value = headers.get('diagnostic-code')
+        if value is not None:
+            # may be multiline
+            rcpt["diag_code"] = unfold(value)
+
+        rcpt["status"] = headers.get('status')
+
+        if debug:
+            logging.debug("DEBUG: adding final_rpct=%s, orig_rcpt=%s",
+                          rcpt["final_rcpt"], rcpt["orig_rcpt"])
+        recipients.append(rcpt)
+
+    return recipients
+
+def get_orig_subject(part, content_type: str):
+
+    """
+    return the Subject of the original message from a
+    message/rfc822 or text/rfc822-headers part, None if not found
+    """
+
+    if content_type == "message/rfc822":
+        # the payload is a list holding only the embedded message,
+        # it's own headers carry the Subject, no need to walk() it
+        payload = part.get_payload()
+        if not isinstance(payload, list) or not payload:
+            return None
+        headers = payload[0]
+    else:
+        # the part contain only headers, don't parse it as a full message
+        # pylint: disable=import-outside-toplevel
+        import email.parser
+        import email.policy
+        headers = email.parser.HeaderParser(
+            policy=email.policy.compat32).parsestr(part.get_payload())
+
+    subject = get_header(headers, 'Subject')
+    if subject is None:
+        return None
+
+    subject = unfold(subject)
+    logging.debug("DEBUG: orig_subject=%s", subject)
+    return subject
+
+def process_dsn(mail_data: bytes):
 
     """
     process the email, extract dsn data
     """
 
-    msg = email.message_from_string(mail_data)
+    # a dsn has a delivery-status part, a Google Groups dsn has a
+    # X-Failed-Recipients header. Without both, don't parse the message at all
+    mail_data_lower = mail_data.lower()
+    if (b'message/delivery-status' not in mail_data_lower
+            and b'x-failed-recipients' not in mail_data_lower):
+        logging.error("ERROR: no delivery-status and no x-failed-recipients, "
+            "probably not a dsn")
+        save_message('not_a_dsn')
+        sys.exit(0)
+
+    # email is imported only where needed,
+    # it take noticeable time to import on every run of this program
+    # pylint: disable=import-outside-toplevel
+    import email.parser
+    import email.policy
+
+    # parse the raw bytes, no decoded copy of the message is needed
+    # compat32 avoid the header objects of newer policies, name it explicit
+    msg = email.parser.BytesParser(policy=email.policy.compat32).parsebytes(mail_data)
     recipients = []
     orig_subject = None
     report_domain = None
 
+    # a dsn has exactly one delivery-status part
+    have_status = False
+
     for part in msg.walk():
-        if part.get_content_type() == "message/delivery-status":
-            for subpart in part.walk():
-                rcpt = {}
-                # https://datatracker.ietf.org/doc/html/rfc3461#section-6.3
-                if 'Action' in subpart and 'Final-Recipient' in subpart:
-                    rcpt["action"] = subpart['Action']
-                    if rcpt["action"] == 'delayed':
-                        logging.info('INFO: this is only about a delayed delivery')
-                        sys.exit(0)
-
-                    rcpt["final_rcpt"] = re.sub(RE_822_PREFIX, '', subpart['Final-Recipient'])
-                    if 'Original-Recipient' in subpart:
-                        rcpt["orig_rcpt"] = re.sub(RE_822_PREFIX, '', subpart['Original-Recipient'])
-                    else:
-                        rcpt["orig_rcpt"] = rcpt["final_rcpt"]
-
-                    rcpt["diag_code"] = None
-                    if 'Diagnostic-Code' in subpart:
-                        # may be multiline
-                        rcpt["diag_code"] = unfold(subpart['Diagnostic-Code'])
-
-                    rcpt["status"] = None
-                    if 'Status' in subpart:
-                        rcpt["status"] = subpart['Status']
-
-                    logging.debug("DEBUG: adding final_rpct=%s, orig_rcpt=%s",
-                                  rcpt["final_rcpt"], rcpt["orig_rcpt"])
-                    recipients.append(rcpt)
-
-        if part.get_content_type() == "message/rfc822":
-            for subpart in part.walk():
-                if orig_subject is None and subpart["Subject"] is not None:
-                    orig_subject = unfold(subpart["Subject"])
-                    logging.debug("DEBUG: orig_subject=%s", orig_subject)
-
-        if part.get_content_type() == "text/rfc822-headers":
-            payload = email.message_from_string(part.get_payload())
-            if orig_subject is None and payload["Subject"] is not None:
-                orig_subject = unfold(payload["Subject"])
-                logging.debug("DEBUG: orig_subject=%s", orig_subject)
+        content_type = part.get_content_type()
+
+        if content_type == "message/delivery-status":
+            have_status = True
+            recipients.extend(process_delivery_status(part))
+
+        # the first Subject found is used, don't look at further parts
+        elif orig_subject is None and content_type in ("message/rfc822", "text/rfc822-headers"):
+            orig_subject = get_orig_subject(part, content_type)
+
+        # all found, skip the remaining parts like the attached report
+        if have_status and orig_subject is not None:
+            break
 
     report_domain = get_report_domain_from_subject(orig_subject)
 
@@ -232,32 +402,64 @@ def process_dsn(mail_data: str):
     if not recipients:
         recipients = process_googlegroups_dsn(msg)
 
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     for rcpt in recipients:
         if "report_domain" not in rcpt:
-            logging.debug("DEBUG: rcpt=%s, adding report_domain='%s'",
-                rcpt['orig_rcpt'], report_domain)
+            if debug:
+                logging.debug("DEBUG: rcpt=%s, adding report_domain='%s'",
+                    rcpt['orig_rcpt'], report_domain)
             rcpt["report_domain"] = report_domain
-        rcpt["date"] = DATE
+        rcpt["date"] = get_date()
 
     return recipients
 
+def dsn_to_json(dsn: dict):
+
+    """
+    return dsn as one line of json, encoded as bytes
+    """
+
+    if HAVE_ORJSON:
+        return orjson.dumps(dsn) + b"\n" # pylint: disable=no-member
+    # same compact utf-8 output as orjson
+    return (json.dumps(dsn, separators=(',', ':'), ensure_ascii=False) + "\n").encode('utf-8')
+
 def dsn_detail_to_data_dir(dsn_detail: dict, data_dir: str):
 
     """
     append dsn_details to a file in data_dir
     """
 
+    # group lines by report_domain, so each file is opened only once
+    lines_by_domain = defaultdict(list)
     for dsn in dsn_detail:
         report_domain = dsn['report_domain']
         if report_domain is not None:
-            logging.info("INFO: saving dsn_details for domain '%s'", report_domain)
-            filename = data_dir + '/domains/' + report_domain
-            with open(filename, 'a', encoding="utf-8") as file:
-                file.write(json.dumps(dsn) + "\n")
+            lines_by_domain[report_domain].append(dsn_to_json(dsn))
         else:
             logging.error("ERROR: no report_domain in '%s'", dsn)
             save_message('no_report_domain')
 
+    domains_prefix = os.path.join(data_dir, 'domains', '')
+    last_prefix = os.path.join(data_dir, 'last', '')
+
+    for report_domain, lines in lines_by_domain.items():
+        logging.info("INFO: saving dsn_details for domain '%s'", report_domain)
+        filename = domains_prefix + report_domain
+        # one write() per domain, so records of parallel deliveries
+        # to the same domain file don't get interleaved
+        with open(filename, 'ab') as file:
+            file.write(b''.join(lines))
+
+        # keep the most recent record in a file of it's own,
+        # build_postfix_discard_table.py only need this one
+        # write to a temporary file first, readers never see a partial record
+        filename = last_prefix + report_domain
+        tmp_filename = filename + '.' + str(os.getpid())
+        with open(tmp_filename, 'wb') as file:
+            file.write(lines[-1])
+        os.replace(tmp_filename, filename)
+
 def save_message(reason: str):
 
     """
@@ -265,18 +467,16 @@ def save_message(reason: str):
     """
 
     pathname = DATA_DIR + '/saved/' + QUEUE_ID + '.' + reason
-    with open(pathname, 'a', encoding='utf-8') as file:
+    # the raw bytes, exactly as received
+    with open(pathname, 'ab') as file:
         file.write(MAIL_DATA)
-        file.close()
-        logging.debug("DEBUG: messages saved to '%s'", pathname)
+    logging.debug("DEBUG: messages saved to '%s'", pathname)
 
 # main
 
 # first: slurp the message so it could be saved in case of some errors
-MAIL_DATA = ""
-for line in sys.stdin:
-    # pylint: disable=consider-using-join
-    MAIL_DATA += line
+# keep the raw bytes, they are saved unchanged and parsed as bytes
+MAIL_DATA = sys.stdin.buffer.read()
 
 LOG_LEVEL = logging.INFO
 if os.getenv('VERBOSE'):
@@ -312,26 +512,23 @@ if not os.access(DATA_DIR, os.W_OK):
     sys.exit(1)
 
 # create subdirs
-for subdir in [ 'domains', 'saved']:
-    try:
-        os.mkdir(DATA_DIR + '/' + subdir + '/')
-    except FileExistsError:
-        # ignore if subdir already exist
-        pass
+for subdir in [ 'domains', 'last', 'saved']:
+    # ignore if subdir already exist
+    os.makedirs(os.path.join(DATA_DIR, subdir), exist_ok=True)
 # TODO: catch more errors
 
 # now we may call 'save_message' ...
 
-today = datetime.date.today()
-DATE = today.strftime("%Y%m%d")
-
 if EXTENSION != "":
     logging.debug("DEBUG: extension='%s'", EXTENSION)
-    dsn_details = process_with_extension(EXTENSION, MAIL_DATA)
+    dsn_details = process_with_extension(EXTENSION,
+        MAIL_DATA.decode('utf-8', errors='replace'))
 else:
     dsn_details = process_dsn(MAIL_DATA)
 
-logging.debug("DEBUG: dsn_details='%s'", dsn_details)
+# dsn_details may be a long list
+if logging.getLogger().isEnabledFor(logging.DEBUG):
+    logging.debug("DEBUG: dsn_details='%s'", dsn_details)
 if not dsn_details:
     logging.debug("DEBUG: dsn_details is empty")
     save_message('no_dsn_details')